@@ -8,38 +8,54 @@ Stardew Valley HD Portrait Patcher by purplexpresso
 __version__ = "1.4.0"
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum, auto
-from collections import defaultdict
+import glob
+import os
 import pathlib
-import re as regex
-from copy import deepcopy
-from typing import Any, Dict, Final, List, DefaultDict, Callable
-from functools import partial
+import re
+from typing import Any, Dict, Final, List, Tuple, Callable
 
 import json5
+import orjson
+
+_CP_TOKEN_RE: Final = re.compile(r"\{\{[a-zA-Z0-9_./]+\}\}")
+# digit runs orjson may parse as a lossy float instead of an exact integer
+_WIDE_INT_RE: Final = re.compile(rb"-\d{19}|\d{20}")
+_MAX_WORKERS: Final = 61  # ProcessPoolExecutor's limit on Windows
 
 
 def _clone_dir_tree(source: pathlib.Path, destination: pathlib.Path) -> None:
-    import shutil
-
-    shutil.copytree(
-        source.resolve(),
-        destination.resolve(),
-        ignore=lambda directory, files: [
-            file for file in files if (pathlib.Path(directory) / file).is_file()
-        ],
-        dirs_exist_ok=not (source.name in destination.parts),  # prevent recursion
+    source_root: Final = str(source.resolve())
+    destination_root: Final = str(destination.resolve())
+
+    os.makedirs(
+        destination_root,
+        exist_ok=not (source.name in destination.parts),  # prevent recursion
     )
+    # follow symlinked folders like copytree did, files may be written under them
+    for root, dirs, _ in os.walk(source_root, followlinks=True):
+        # never descend into the copy itself when it lives inside the source
+        dirs[:] = [
+            subdir
+            for subdir in dirs
+            if not (destination_root + os.sep).startswith(
+                os.path.join(root, subdir) + os.sep
+            )
+        ]
+        os.makedirs(
+            os.path.join(destination_root, os.path.relpath(root, source_root)),
+            exist_ok=True,
+        )
 
 
 def _get_variant_metadata_file(
-    portrait_file: pathlib.Path, variant: str | None, VARIANT_SEPARATOR: str
-) -> pathlib.Path:
-    return portrait_file.with_name(
-        portrait_file.stem
-        if variant is None or portrait_file.stem.endswith(variant)
-        else f"{portrait_file.stem}{VARIANT_SEPARATOR}{variant}"
-    ).with_suffix(".json")
+    portrait_file: str, variant: str | None, VARIANT_SEPARATOR: str
+) -> str:
+    stem, _ = os.path.splitext(portrait_file)
+    if variant is not None and not stem.endswith(variant):
+        stem = f"{stem}{VARIANT_SEPARATOR}{variant}"
+    return stem + ".json"
 
 
 def _get_copy_dir(
@@ -69,6 +85,31 @@ def _get_file_or_backup(file: pathlib.Path) -> pathlib.Path:
     return backup_file if backup_file.is_file() else file
 
 
+def _load_json(file: pathlib.Path) -> Any:
+    # orjson rejects the UTF-8 BOM that Windows editors often write
+    data = file.read_bytes().removeprefix(b"\xef\xbb\xbf")
+    if not _WIDE_INT_RE.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    # not strict JSON (comments, trailing commas, etc.) or holds integers outside
+    # 64 bits that orjson would turn into floats, fall back to json5
+    return json5.loads(data.decode("utf-8"))
+
+
+def _dump_json(file: pathlib.Path, json_data: Any) -> None:
+    try:
+        data = orjson.dumps(
+            json_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
+    except orjson.JSONEncodeError:
+        # values orjson refuses, e.g. integers wider than 64 bits, which
+        # _load_json leaves to json5 so they keep their exact value
+        data = json5.dumps(json_data, quote_keys=True, indent=2).encode("utf-8")
+    file.write_bytes(data)
+
+
 def _write_and_backup(
     file: pathlib.Path,
     json_data: Dict[str, Any],
@@ -79,38 +120,54 @@ def _write_and_backup(
     backup_file = file.with_suffix(".bak")
     if not (force_rewrite or copy_dir or backup_file.is_file()):
         file.rename(backup_file)
-    with (
-        file if copy_dir is None else copy_dir / file.relative_to(main_dir)
-    ).with_suffix(".json").open("w+") as new_file:
-        json5.dump(json_data, new_file, quote_keys=True, indent=4)
+    _dump_json(
+        (
+            file if copy_dir is None else copy_dir / file.relative_to(main_dir)
+        ).with_suffix(".json"),
+        json_data,
+    )
 
 
-def update_dependencies(manifest_file: pathlib.Path) -> Dict[str, Any]:
-    with manifest_file.open("r") as manifest:
-        manifest_dict: DefaultDict[str, Any] = defaultdict(list, json5.load(manifest)) # type: ignore
+def update_dependencies(manifest_file: pathlib.Path) -> Tuple[Dict[str, Any], bool]:
+    manifest_dict: Dict[str, Any] = _load_json(manifest_file)
 
     PYTK_DEPENDENCY: Final = {"UniqueID": "Platonymous.Toolkit"}
     HD_PORTRAITS_DEPENDENCY: Final = {"UniqueID": "tlitookilakin.HDPortraits"}
 
-    dependencies: List[Dict[str, str]] = manifest_dict["Dependencies"]
-    if HD_PORTRAITS_DEPENDENCY not in dependencies:
+    GENERATED_BY: Final = f"Generated by Portrait Patcher {__version__}, by purplexpresso. Licensed under GPLv3."
+
+    has_hd_portraits = False
+    has_pytk = False
+    dependencies: List[Dict[str, str]] = []
+    for dependency in manifest_dict.get("Dependencies", []):
+        if dependency == PYTK_DEPENDENCY:
+            has_pytk = True
+            continue
+        if dependency == HD_PORTRAITS_DEPENDENCY:
+            has_hd_portraits = True
+        dependencies.append(dependency)
+    # already patched by this version, nothing to rewrite
+    if (
+        has_hd_portraits
+        and not has_pytk
+        and manifest_dict.get("GeneratedBy") == GENERATED_BY
+    ):
+        return manifest_dict, False
+
+    if not has_hd_portraits:
         dependencies.append(HD_PORTRAITS_DEPENDENCY)
-    try:
-        dependencies.remove(PYTK_DEPENDENCY)
-    except ValueError:
-        pass
-    
-    manifest_dict["GeneratedBy"] = f"Generated by Portrait Patcher {__version__}, by purplexpresso. Licensed under GPLv3."
+    manifest_dict["Dependencies"] = dependencies
+
+    manifest_dict["GeneratedBy"] = GENERATED_BY
 
-    return dict(manifest_dict)
+    return manifest_dict, True
 
 
 def create_metadata_json(
     portrait_file: pathlib.Path, target_name: str
 ) -> Dict[str, Any] | None:
     try:
-        with portrait_file.with_suffix(".pytk.json").open("r") as pytk_file:
-            pytk_dict: Dict[str, Any] = json5.load(pytk_file) # type: ignore
+        pytk_dict: Dict[str, Any] = _load_json(portrait_file.with_suffix(".pytk.json"))
     except FileNotFoundError:
         return None
 
@@ -161,104 +218,117 @@ def content_patcher_portraits(
     if copy_dir is not None:
         _clone_dir_tree(content_patch_dir, copy_dir)
     content_file: Final = _get_file_or_backup(content_patch_dir / "content.json")
+    content_patch_dir_str: Final = str(content_patch_dir)
+    content_patch_dir_prefix: Final = content_patch_dir_str + os.sep
+    hd_portraits_prefix: Final = hd_portraits.as_posix() + "/"
+    hd_portraits_patch_prefix: Final = hd_portraits_patch.as_posix() + "/"
 
-    content_patcher_token: Final = regex.compile(r"\{\{[a-zA-Z0-9_./]+\}\}")
-    with content_file.open("r") as content:
-        content_dict: Dict[str, Any] = json5.load(content) # type: ignore
+    content_dict: Dict[str, Any] = _load_json(content_file)
 
-    parsed_metadata_files: Dict[pathlib.Path, FileParsed] = {}
+    parsed_metadata_files: Dict[str, FileParsed] = {}
     metadata_item: Dict[str, Any]
-    for index, metadata_item in enumerate(content_dict["Changes"].copy()):
+    changes: List[Dict[str, Any]] = []
+    metadata_writes: List[Tuple[pathlib.Path, Dict[str, Any]]] = []
+    for metadata_item in content_dict["Changes"]:
         portrait_name: Final = pathlib.PurePath(metadata_item["Target"])
         if portrait_name.parent.stem != "Portraits":
+            changes.append(metadata_item)
             continue
 
-        target_variant: str | None = (
-            VARIANT_SEPARATOR.join(portrait_name.stem.split(VARIANT_SEPARATOR)[1:])
-            or None
-        )
+        _, _, target_variant_name = portrait_name.stem.partition(VARIANT_SEPARATOR)
+        target_variant: str | None = target_variant_name or None
 
-        portrait_file: Final = content_patch_dir / pathlib.PurePath(
+        # normalized like PurePath.as_posix() so both generated entries agree
+        portrait_file_relative: Final = os.path.normpath(
             metadata_item["FromFile"]
+        ).replace(os.sep, "/")
+        portrait_file: Final = os.path.join(
+            content_patch_dir_str, portrait_file_relative
         )
         metadata_file: Final = _get_variant_metadata_file(
             portrait_file, target_variant, VARIANT_SEPARATOR
         )
 
-        hd_portraits_target_path: Final = hd_portraits / portrait_name.stem
-        hd_portraits_patch_target_path: Final = hd_portraits_patch / portrait_name.stem
+        hd_portraits_target: Final = hd_portraits_prefix + portrait_name.stem
+        hd_portraits_patch_target: Final = hd_portraits_patch_prefix + portrait_name.stem
 
         metadata_item.pop("PatchMode", None)
 
-        portrait_item = deepcopy(metadata_item)
+        portrait_item = {
+            **metadata_item,
+            "Action": "EditImage",
+            "Target": hd_portraits_patch_target,
+            "FromFile": portrait_file_relative,
+        }
 
         metadata_item["Action"] = "Load"
-        metadata_item["Target"] = hd_portraits_target_path.as_posix()
-        metadata_item["FromFile"] = metadata_file.relative_to(
-            content_patch_dir
-        ).as_posix()
-
-        portrait_item["Action"] = "EditImage"
-        portrait_item["Target"] = hd_portraits_patch_target_path.as_posix()
-        portrait_item["FromFile"] = portrait_file.relative_to(
-            content_patch_dir
-        ).as_posix()
-
-        content_dict["Changes"].insert(2 * index, portrait_item)
-
-        if content_patcher_token.search(portrait_file.stem):
-            glob_string: str = regex.sub(
-                content_patcher_token,
-                CP_WILDCARD,
-                str(portrait_file.relative_to(content_patch_dir)),
-            )
-            for globbed_portrait_file in content_patch_dir.glob(glob_string):
+        metadata_item["Target"] = hd_portraits_target
+        metadata_item["FromFile"] = (
+            metadata_file.removeprefix(content_patch_dir_prefix)
+            .replace(os.sep, "/")
+        )
+
+        changes.append(portrait_item)
+        changes.append(metadata_item)
+
+        portrait_file_name: Final = os.path.basename(portrait_file)
+        # cheap substring check first, most FromFile values carry no CP token
+        if "{{" in portrait_file_name and _CP_TOKEN_RE.search(portrait_file_name):
+            glob_string: str = _CP_TOKEN_RE.sub(CP_WILDCARD, portrait_file_relative)
+            # glob relative to the mod folder so names like "[CP] Abby" are not
+            # read as patterns, and match hidden files like Path.glob did
+            for globbed_portrait_name in glob.iglob(
+                glob_string, root_dir=content_patch_dir_str, include_hidden=True
+            ):
+                globbed_portrait_path = os.path.join(
+                    content_patch_dir_str, globbed_portrait_name
+                )
                 globbed_metadata_file = _get_variant_metadata_file(
-                    globbed_portrait_file, target_variant, VARIANT_SEPARATOR
+                    globbed_portrait_path, target_variant, VARIANT_SEPARATOR
                 )
 
-                if globbed_metadata_file.resolve() in parsed_metadata_files:
+                globbed_metadata_key = os.path.normpath(globbed_metadata_file)
+                if globbed_metadata_key in parsed_metadata_files:
                     continue
 
-                parsed_metadata_files[
-                    globbed_metadata_file.resolve()
-                ] = FileParsed.GLOBBED
+                parsed_metadata_files[globbed_metadata_key] = FileParsed.GLOBBED
 
                 globbed_metadata_json = create_metadata_json(
-                    globbed_portrait_file, hd_portraits_patch_target_path.as_posix()
+                    pathlib.Path(globbed_portrait_path),
+                    hd_portraits_patch_target,
                 )
                 if globbed_metadata_json is None:
                     continue
 
-                _write_and_backup(
-                    globbed_metadata_file,
-                    globbed_metadata_json,
-                    content_patch_dir,
-                    copy_dir,
-                    force_rewrite=True,
+                metadata_writes.append(
+                    (pathlib.Path(globbed_metadata_file), globbed_metadata_json)
                 )
-        elif portrait_file.is_file():
-            if (
-                parsed_metadata_files.get(metadata_file.resolve())
-                is FileParsed.INDIVIDUAL
-            ):
+        elif os.path.isfile(portrait_file):
+            # metadata files all live under content_patch_dir, so a normalized
+            # path is enough to dedupe them without resolve()'s syscalls
+            metadata_key = os.path.normpath(metadata_file)
+            if parsed_metadata_files.get(metadata_key) is FileParsed.INDIVIDUAL:
                 continue
 
-            parsed_metadata_files[metadata_file.resolve()] = FileParsed.INDIVIDUAL
+            parsed_metadata_files[metadata_key] = FileParsed.INDIVIDUAL
             metadata_json = create_metadata_json(
-                portrait_file, hd_portraits_patch_target_path.as_posix()
+                pathlib.Path(portrait_file), hd_portraits_patch_target
             )
             if metadata_json is None:
                 continue
 
-            _write_and_backup(
-                metadata_file,
-                metadata_json,
-                content_patch_dir,
-                copy_dir,
-                force_rewrite=True,
-            )
-    
+            metadata_writes.append((pathlib.Path(metadata_file), metadata_json))
+
+    for metadata_write_file, metadata_write_json in metadata_writes:
+        _write_and_backup(
+            metadata_write_file,
+            metadata_write_json,
+            content_patch_dir,
+            copy_dir,
+            force_rewrite=True,
+        )
+
+    content_dict["Changes"] = changes
     content_dict["Format"] = "1.28.0"
 
     _write_and_backup(
@@ -269,14 +339,27 @@ def content_patcher_portraits(
     )
 
     manifest_file: Final = _get_file_or_backup(content_patch_dir / "manifest.json")
-    manifest_dict: Final = update_dependencies(manifest_file)
+    patched_manifest_file: Final = (
+        content_patch_dir if copy_dir is None else copy_dir
+    ) / "manifest.json"
+    manifest_dict, manifest_changed = update_dependencies(manifest_file)
+    if patched_manifest_file == manifest_file:
+        # internal mode without a backup yet, rewrite only if something changed
+        manifest_outdated = manifest_changed
+    else:
+        # a previous run may have left this exact manifest behind already
+        manifest_outdated = not (
+            patched_manifest_file.is_file()
+            and _load_json(patched_manifest_file) == manifest_dict
+        )
 
-    _write_and_backup(
-        manifest_file,
-        manifest_dict,
-        content_patch_dir,
-        copy_dir,
-    )
+    if manifest_outdated:
+        _write_and_backup(
+            manifest_file,
+            manifest_dict,
+            content_patch_dir,
+            copy_dir,
+        )
 
 
 ModTypeFunctions = Callable[
@@ -284,18 +367,36 @@ ModTypeFunctions = Callable[
 ]
 
 
-class ModType(Enum):
-    CONTENT_PATCHER: ModTypeFunctions = partial(content_patcher_portraits)  # type: ignore
-    SHOP_TILE_FRAMEWORK: ModTypeFunctions = partial(shop_tile_framework_portraits)  # type: ignore
+# in order of precedence when a folder contains more than one
+MOD_DISPATCH: Final[Dict[str, ModTypeFunctions]] = {
+    "content.json": content_patcher_portraits,
+    "shops.json": shop_tile_framework_portraits,
+}
+
 
-    @classmethod
-    def identify_folder(cls, directory: pathlib.Path):
-        if (directory / "content.json").is_file():
-            return ModType.CONTENT_PATCHER
-        elif (directory / "shops.json").is_file():
-            return ModType.SHOP_TILE_FRAMEWORK
-        else:
-            return None
+def identify_folder(directory: pathlib.Path) -> ModTypeFunctions | None:
+    with os.scandir(directory) as entries:
+        mod_files = {
+            entry.name
+            for entry in entries
+            if entry.name in MOD_DISPATCH and entry.is_file()
+        }
+    for mod_file, mod_function in MOD_DISPATCH.items():
+        if mod_file in mod_files:
+            return mod_function
+    return None
+
+
+ModEntry = Tuple[ModTypeFunctions, pathlib.Path, pathlib.Path | None]
+
+
+def _patch_mods(
+    mods: List[ModEntry],
+    hd_portraits: pathlib.PurePath,
+    hd_portraits_patch: pathlib.PurePath,
+) -> None:
+    for mod_type, mod_dir, mod_copy_dir in mods:
+        mod_type(mod_dir, mod_copy_dir, hd_portraits, hd_portraits_patch)
 
 
 def main() -> None:
@@ -344,26 +445,49 @@ def main() -> None:
         )
         return
 
-    main_folder_type: ModType | None = ModType.identify_folder(directory)
+    main_folder_type: ModTypeFunctions | None = identify_folder(directory)
     if main_folder_type is not None:
-        main_folder_type.value(
+        main_folder_type(
             directory,
             _get_copy_dir(copy_dir, copy_mode, directory, directory),
             hd_portraits,
             hd_portraits_patch,
         )
     else:
+        # mods are grouped by the folder they write to, copies are named after the
+        # folder stem so e.g. "X v1.2" and "X v1.3" share one output folder
+        mod_groups: Dict[pathlib.Path, List[ModEntry]] = {}
         for subdirectory in directory.iterdir():
             if not subdirectory.is_dir():
                 continue
-            subdirectory_type: ModType | None = ModType.identify_folder(subdirectory)
+            subdirectory_type: ModTypeFunctions | None = identify_folder(subdirectory)
             if subdirectory_type is not None:
-                subdirectory_type.value(
-                    subdirectory,
-                    _get_copy_dir(copy_dir, copy_mode, directory, subdirectory),
-                    hd_portraits,
-                    hd_portraits_patch,
+                subdirectory_copy_dir = _get_copy_dir(
+                    copy_dir, copy_mode, directory, subdirectory
                 )
+                mod_groups.setdefault(
+                    subdirectory_copy_dir or subdirectory, []
+                ).append((subdirectory_type, subdirectory, subdirectory_copy_dir))
+
+        if not mod_groups:
+            return
+
+        for output_dir, mods in mod_groups.items():
+            if len(mods) > 1:
+                print(
+                    f"{', '.join(mod_dir.name for _, mod_dir, _ in mods)} all write to {output_dir}, converting them one after another. The last one wins!"
+                )
+
+        # groups write to separate folders, so convert them in parallel
+        with ProcessPoolExecutor(
+            max_workers=min(len(mod_groups), os.cpu_count() or 1, _MAX_WORKERS)
+        ) as executor:
+            futures = [
+                executor.submit(_patch_mods, mods, hd_portraits, hd_portraits_patch)
+                for mods in mod_groups.values()
+            ]
+            for future in futures:
+                future.result()
 
     return
 